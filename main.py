@@ -2,10 +2,24 @@
 
 import asyncio
 import json
+import logging
 import copy
+import random
+import time
 import re
 import hashlib
-from typing import Dict, Any, Optional
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional
+
+try:
+    from asyncio import timeout as _aio_timeout
+except ImportError:  # Python < 3.11
+    from async_timeout import timeout as _aio_timeout
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库
+    _json_loads = json.loads
 
 import astrbot.api.message_components as Comp
 from astrbot.api import logger, AstrBotConfig
@@ -18,12 +32,77 @@ from astrbot.api.event import (
 )
 
 
+# 从错误文本中提取 4xx/5xx 状态码
+_STATUS_CODE_RE = re.compile(r"\b([45]\d{2})\b")
+# 状态码配置每行一个；只有 4xx/5xx 会被 _STATUS_CODE_RE 提取，其余行无意义
+# 使用 [0-9] 而非 \d，只接受 ASCII 数字
+_STATUS_CODE_LINE_RE = re.compile(r"^\s*([45][0-9]{2})\s*$", re.MULTILINE)
+
+# 需要随请求一同保存并在重试时恢复的Provider参数
+_PROVIDER_PARAM_NAMES = (
+    "model",
+    "temperature",
+    "max_tokens",
+    "top_p",
+    "top_k",
+    "frequency_penalty",
+    "presence_penalty",
+    "stop",
+    "stream",
+)
+
+
+def _consume_task_exception(task: asyncio.Task) -> None:
+    """读取已结束任务的异常，避免被取消的并发任务产生 "exception was never retrieved" 警告"""
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logger.debug(f"并发任务 {task.get_name()} 结束时出现异常（已忽略）: {exc}")
+
+
+def _choice_finish_reason(completion) -> Optional[str]:
+    """读取 completion.choices[0].finish_reason，任一环节缺失时返回 None"""
+    try:
+        return completion.choices[0].finish_reason
+    except (AttributeError, IndexError, TypeError):
+        return None
+
+
+def _raw_finish_reason(resp) -> Optional[str]:
+    """读取 resp.raw_completion.choices[0].finish_reason，任一环节缺失时返回 None"""
+    return _choice_finish_reason(getattr(resp, "raw_completion", None))
+
+
+@dataclass(slots=True)
+class StoredRequest:
+    """存储的LLM请求参数快照（使用 __slots__ 降低每条请求的内存占用）"""
+
+    prompt: str
+    unified_msg_origin: str
+    contexts: List[Any] = field(default_factory=list)
+    image_urls: List[str] = field(default_factory=list)
+    system_prompt: str = ""
+    func_tool: Any = None
+    # Bug 1.1: Store conversation_id instead of live object
+    conversation_id: Optional[str] = None
+    persona_id: Optional[str] = None
+    sender: Dict[str, Any] = field(default_factory=dict)
+    provider_params: Dict[str, Any] = field(default_factory=dict)
+
+
 class Main(Star):
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
 
         # 请求存储（借鉴v2版本的设计）
-        self.pending_requests: Dict[str, Dict[str, Any]] = {}
+        self.pending_requests: Dict[str, StoredRequest] = {}
+
+        # 检测到 429 限流后的冷却截止时间（time.monotonic），冷却期内的重试会先等待
+        self._cooldown_until = 0.0
+
+        # 尚未结束的并发重试任务，取消后不再等待，由插件卸载时统一回收
+        self._inflight_tasks: set = set()
 
         # 解析配置
         self._parse_config(config)
@@ -46,6 +125,10 @@ class Main(Star):
         self.retry_delay_mode = (
             config.get("retry_delay_mode", "exponential").lower().strip()
         )
+        self._exponential_delay = self.retry_delay_mode == "exponential"
+        # 429 限流冷却时长：取基础重试间隔（上限30秒，为0时不冷却），顺序与并发重试共用
+        # 冷却与顺序重试的等待同时计时，本会话实际等待取两者中较长者
+        self._rate_limit_cooldown = float(min(max(int(self.retry_delay), 0), 30))
 
         # 错误关键词配置
         default_keywords = (
@@ -59,9 +142,22 @@ class Main(Star):
             "timeout"
         )
         keywords_str = config.get("error_keywords", default_keywords)
-        self.error_keywords = [
-            k.strip().lower() for k in keywords_str.split("\n") if k.strip()
-        ]
+        # dict.fromkeys 去重并保持配置顺序，避免重复关键词进入正则
+        self.error_keywords = self._prune_keywords(
+            dict.fromkeys(
+                k.strip().lower() for k in keywords_str.split("\n") if k.strip()
+            )
+        )
+        # 预编译为单个不区分大小写的正则，一次扫描即可匹配全部关键词
+        self._error_kw_regex = (
+            re.compile(
+                "|".join(re.escape(k) for k in self.error_keywords), re.IGNORECASE
+            )
+            if self.error_keywords
+            else None
+        )
+        # 比最短关键词还短的文本不可能命中任何关键词，可跳过正则扫描
+        self._min_keyword_len = min(map(len, self.error_keywords), default=0)
 
         # 基于状态码的重试控制
         self.retryable_status_codes = self._parse_status_codes(
@@ -70,12 +166,19 @@ class Main(Star):
         self.non_retryable_status_codes = self._parse_status_codes(
             config.get("non_retryable_status_codes", "")
         )
+        # 两个状态码列表都为空时，状态码提取不会影响判断，可直接跳过
+        self._check_status_codes = bool(
+            self.retryable_status_codes or self.non_retryable_status_codes
+        )
 
         # 兜底回复
-        self.fallback_reply = config.get(
-            "fallback_reply",
-            "抱歉，刚才遇到服务波动，我已自动为你重试多次仍未成功。请稍后再试或换个说法。",
-        )
+        self.fallback_reply = str(
+            config.get(
+                "fallback_reply",
+                "抱歉，刚才遇到服务波动，我已自动为你重试多次仍未成功。请稍后再试或换个说法。",
+            )
+            or ""
+        ).strip()
 
         # 截断重试配置
         self.enable_truncation_retry = bool(
@@ -103,9 +206,15 @@ class Main(Star):
         self.max_concurrent_multiplier = max(
             2, min(int(config.get("max_concurrent_multiplier", 4)), 8)
         )
+        self.enable_backoff_jitter = bool(config.get("enable_backoff_jitter", True))
         self.absolute_concurrent_limit = max(
             5, min(int(config.get("absolute_concurrent_limit", 10)), 20)
         )
+        # 单批次并发数上限：基础并发数的倍数与绝对上限取较小者
+        self._hard_concurrent_cap = min(
+            self.concurrent_retry_count * self.max_concurrent_multiplier,
+            self.absolute_concurrent_limit,
+        )
 
         # 超时时间限制，遵循官方资源管理规范
         timeout = int(config.get("concurrent_retry_timeout", 30))
@@ -113,27 +222,24 @@ class Main(Star):
 
         # 配置验证日志 - 使用官方logger规范
         if self.enable_concurrent_retry:
-            max_concurrent = min(
-                self.concurrent_retry_count * self.max_concurrent_multiplier,
-                self.absolute_concurrent_limit,
-            )
             logger.info(
                 f"并发重试配置: 阈值={self.concurrent_retry_threshold}(0=立即并发), "
-                f"基础并发数={self.concurrent_retry_count}, 最大并发={max_concurrent}, "
+                f"基础并发数={self.concurrent_retry_count}, 最大并发={self._hard_concurrent_cap}, "
                 f"超时={self.concurrent_retry_timeout}s, 指数增长={'启用' if self.enable_exponential_growth else '禁用'}"
             )
 
-    def _parse_status_codes(self, codes_str: str) -> set:
-        """解析状态码配置字符串"""
-        codes = set()
-        for line in codes_str.split("\n"):
-            line = line.strip()
-            if line.isdigit():
-                try:
-                    codes.add(int(line))
-                except Exception:
-                    pass
-        return codes
+    def _prune_keywords(self, keywords) -> list:
+        """剔除包含其他关键词的冗余关键词（命中长词必然命中其子串），保持原有顺序"""
+        kept = []
+        for keyword in sorted(keywords, key=len):
+            if not any(shorter in keyword for shorter in kept):
+                kept.append(keyword)
+        kept_set = set(kept)
+        return [k for k in keywords if k in kept_set]
+
+    def _parse_status_codes(self, codes_str: str) -> frozenset:
+        """解析状态码配置字符串，返回不可变集合供重试路径做 O(1) 成员判断"""
+        return frozenset(int(m) for m in _STATUS_CODE_LINE_RE.findall(codes_str))
 
     def _get_request_key(self, event: AstrMessageEvent) -> str:
         """生成稳定的请求唯一标识符，修复哈希碰撞风险 (v2.9.9 加固)"""
@@ -170,15 +276,17 @@ class Main(Star):
             if isinstance(comp, Comp.Image) and hasattr(comp, "url") and comp.url
         ]
 
+        conversation = getattr(req, "conversation", None)
+
         # 尝试获取 system_prompt，如果请求中为空，尝试从人格中获取
         system_prompt = getattr(req, "system_prompt", "")
         
         # 优先尝试从 conversation 对象直接获取 system_prompt (新增兜底)
-        if not system_prompt and hasattr(req, "conversation") and req.conversation:
-            system_prompt = getattr(req.conversation, "system_prompt", "")
+        if not system_prompt and conversation:
+            system_prompt = getattr(conversation, "system_prompt", "")
 
-        if not system_prompt and hasattr(req, "conversation") and req.conversation:
-            persona_id = req.conversation.persona_id
+        if not system_prompt and conversation:
+            persona_id = conversation.persona_id
             if persona_id:
                 persona_mgr = getattr(self.context, "persona_manager", None)
                 if persona_mgr:
@@ -190,55 +298,34 @@ class Main(Star):
                     except Exception as e:
                         logger.warning(f"store_llm_request: 尝试补全 system_prompt 失败: {e}")
 
-        # 存储请求参数 - 注意：此时system_prompt已包含完整的人格信息
-        stored_params = {
-            "prompt": req.prompt,
-            # 确认使用深拷贝，防止上下文在重试过程中被外部修改污染 (v2.9.9 加固)
-            "contexts": copy.deepcopy(getattr(req, "contexts", [])),
-            "image_urls": image_urls,
-            "system_prompt": system_prompt,
-            "func_tool": getattr(req, "func_tool", None),
-            "unified_msg_origin": event.unified_msg_origin,
-            # Bug 1.1: Store conversation_id instead of live object
-            "conversation_id": getattr(req.conversation, "id", None) if hasattr(req, "conversation") else None,
-            "persona_id": getattr(req.conversation, "persona_id", None) if hasattr(req, "conversation") else None,
-        }
-        
-        # 显式存储sender信息（第一处修改：存储阶段）
-        stored_params["sender"] = {
-            "user_id": getattr(event.message_obj, "user_id", None),
-            "nickname": getattr(event.message_obj, "nickname", None),
-            "group_id": getattr(event.message_obj, "group_id", None),
-            "platform": getattr(event.message_obj, "platform", None),
-            # 如果有其他sender相关字段也可以在这里添加
-        }
-        
         # 新增：存储Provider的特定参数（model, temperature, max_tokens等）
         # 这些参数对于保证重试的一致性至关重要
-        provider_params = {}
-        
-        # 提取常见的Provider参数
-        if hasattr(req, "model"):
-            provider_params["model"] = getattr(req, "model", None)
-        if hasattr(req, "temperature"):
-            provider_params["temperature"] = getattr(req, "temperature", None)
-        if hasattr(req, "max_tokens"):
-            provider_params["max_tokens"] = getattr(req, "max_tokens", None)
-        if hasattr(req, "top_p"):
-            provider_params["top_p"] = getattr(req, "top_p", None)
-        if hasattr(req, "top_k"):
-            provider_params["top_k"] = getattr(req, "top_k", None)
-        if hasattr(req, "frequency_penalty"):
-            provider_params["frequency_penalty"] = getattr(req, "frequency_penalty", None)
-        if hasattr(req, "presence_penalty"):
-            provider_params["presence_penalty"] = getattr(req, "presence_penalty", None)
-        if hasattr(req, "stop"):
-            provider_params["stop"] = getattr(req, "stop", None)
-        if hasattr(req, "stream"):
-            provider_params["stream"] = getattr(req, "stream", None)
-        
-        # 存储Provider参数
-        stored_params["provider_params"] = provider_params
+        provider_params = {
+            name: getattr(req, name)
+            for name in _PROVIDER_PARAM_NAMES
+            if hasattr(req, name)
+        }
+
+        # 存储请求参数 - 注意：此时system_prompt已包含完整的人格信息
+        stored_params = StoredRequest(
+            prompt=req.prompt,
+            unified_msg_origin=event.unified_msg_origin,
+            # 确认使用深拷贝，防止上下文在重试过程中被外部修改污染 (v2.9.9 加固)
+            contexts=copy.deepcopy(getattr(req, "contexts", [])),
+            image_urls=image_urls,
+            system_prompt=system_prompt,
+            func_tool=getattr(req, "func_tool", None),
+            conversation_id=getattr(conversation, "id", None),
+            persona_id=getattr(conversation, "persona_id", None),
+            # 显式存储sender信息
+            sender={
+                "user_id": getattr(event.message_obj, "user_id", None),
+                "nickname": getattr(event.message_obj, "nickname", None),
+                "group_id": getattr(event.message_obj, "group_id", None),
+                "platform": getattr(event.message_obj, "platform", None),
+            },
+            provider_params=provider_params,
+        )
         
         self.pending_requests[request_key] = stored_params
 
@@ -248,13 +335,15 @@ class Main(Star):
         """从错误文本中提取 4xx/5xx 状态码"""
         if not text:
             return None
-        try:
-            match = re.search(r"\b([45]\d{2})\b", text)
-            if match:
-                return int(match.group(1))
-        except Exception:
-            pass
-        return None
+        match = _STATUS_CODE_RE.search(text)
+        return int(match.group(1)) if match else None
+
+    def _match_error_keyword(self, text: str) -> Optional[str]:
+        """返回文本中命中的首个错误关键词，未命中返回 None"""
+        if self._error_kw_regex is None or len(text) < self._min_keyword_len:
+            return None
+        match = self._error_kw_regex.search(text)
+        return match.group(0) if match else None
 
     def _should_retry_response(self, result) -> bool:
         """判断是否需要重试（重构后的检测逻辑）"""
@@ -262,18 +351,12 @@ class Main(Star):
             logger.debug("结果为空，需要重试")
             return True
 
-        # 检查是否有实际内容
-        has_content = False
-        if hasattr(result, "chain"):
-            for comp in result.chain:
-                # 任何非Plain类型的消息段都算作有内容
-                if not isinstance(comp, Comp.Plain):
-                    has_content = True
-                    break
-                # Plain类型但text非空
-                if hasattr(comp, "text") and str(comp.text).strip():
-                    has_content = True
-                    break
+        # 检查是否有实际内容：任何非Plain类型的消息段，或text非空的Plain消息段
+        has_content = any(
+            not isinstance(comp, Comp.Plain)
+            or str(getattr(comp, "text", "")).strip()
+            for comp in getattr(result, "chain", ())
+        )
 
         if not has_content:
             logger.debug("检测到空回复，需要重试")
@@ -283,14 +366,22 @@ class Main(Star):
         message_str = (
             result.get_plain_text() if hasattr(result, "get_plain_text") else ""
         )
+        return self._should_retry_text(message_str)
+
+    def _should_retry_text(self, message_str: str) -> bool:
+        """对回复文本做截断标记、状态码和错误关键词检测"""
         if message_str:
             # 检查是否包含截断标记
             if "[TRUNCATED_BY_LENGTH]" in message_str:
                 logger.debug("检测到截断标记，需要重试")
                 return True
 
-            # 状态码检测
-            code = self._extract_status_code(message_str)
+            # 状态码检测（未配置任何状态码时整体跳过）
+            code = (
+                self._extract_status_code(message_str)
+                if self._check_status_codes
+                else None
+            )
             if code is not None:
                 if code in self.non_retryable_status_codes:
                     logger.debug(f"检测到状态码 {code}，配置为不可重试，跳过重试")
@@ -300,11 +391,10 @@ class Main(Star):
                     return True
 
             # 关键词检测
-            lower_message_str = message_str.lower()
-            for keyword in self.error_keywords:
-                if keyword in lower_message_str:
-                    logger.debug(f"检测到错误关键词 '{keyword}'，需要重试")
-                    return True
+            keyword = self._match_error_keyword(message_str)
+            if keyword:
+                logger.debug(f"检测到错误关键词 '{keyword}'，需要重试")
+                return True
 
             # 截断检测 - 已移至 retry_on_llm_response 中使用更精确的 finish_reason 判断
             # 这里不再进行基于文本的截断检测，避免误报
@@ -322,19 +412,8 @@ class Main(Star):
         stored_params = self.pending_requests[request_key]
         
         # === 参数验证阶段 ===
-        # 验证核心参数是否存在
-        required_params = ["prompt", "unified_msg_origin"]
-        missing_params = [p for p in required_params if p not in stored_params]
-        
-        if missing_params:
-            logger.error(
-                f"存储的参数缺少必要字段: {', '.join(missing_params)}。"
-                f"这可能是插件版本不兼容导致的。跳过重试。"
-            )
-            return None
-        
         # 验证prompt不为空
-        if not stored_params["prompt"] or not str(stored_params["prompt"]).strip():
+        if not stored_params.prompt or not str(stored_params.prompt).strip():
             logger.error("存储的prompt参数为空，无法进行重试")
             return None
         
@@ -348,16 +427,16 @@ class Main(Star):
             # === 构建重试参数 ===
             kwargs = {
                 # "prompt": stored_params["prompt"], # Bug 1.2: prompt is now part of contexts
-                "image_urls": stored_params.get("image_urls", []),
-                "func_tool": stored_params.get("func_tool", None),
+                "image_urls": stored_params.image_urls,
+                "func_tool": stored_params.func_tool,
             }
             
             # === 鲁棒的 system_prompt 处理逻辑 (v2.9.9 修复竞态条件) ===
             # 核心思路：优先使用快照，失败则尝试实时获取作为兜底
-            system_prompt = stored_params.get("system_prompt")
-            conversation_id = stored_params.get("conversation_id")
-            unified_msg_origin = stored_params.get("unified_msg_origin")
-            persona_id = stored_params.get("persona_id")
+            system_prompt = stored_params.system_prompt
+            conversation_id = stored_params.conversation_id
+            unified_msg_origin = stored_params.unified_msg_origin
+            persona_id = stored_params.persona_id
 
             if system_prompt:
                 logger.debug("重试时优先使用初次请求存储的 system_prompt 快照")
@@ -367,10 +446,10 @@ class Main(Star):
                 try:
                     # 优先使用存储的 conversation_id 和 persona_id
                     target_persona_id = persona_id
+                    conv_mgr = getattr(self.context, "conversation_manager", None)
                     
                     # 如果没有存储的 persona_id，尝试从会话中获取
                     if not target_persona_id and conversation_id and unified_msg_origin:
-                        conv_mgr = getattr(self.context, "conversation_manager", None)
                         if conv_mgr:
                             conversation = await conv_mgr.get_conversation(unified_msg_origin, conversation_id)
                             if conversation:
@@ -378,7 +457,6 @@ class Main(Star):
 
                     # 如果仍然没有，尝试从当前会话获取（最后的兜底）
                     if not target_persona_id and unified_msg_origin:
-                        conv_mgr = getattr(self.context, "conversation_manager", None)
                         if conv_mgr:
                             curr_cid = await conv_mgr.get_curr_conversation_id(unified_msg_origin)
                             conversation = await conv_mgr.get_conversation(unified_msg_origin, curr_cid)
@@ -391,6 +469,8 @@ class Main(Star):
                             persona = await persona_mgr.get_persona(target_persona_id)
                             if persona and persona.system_prompt:
                                 system_prompt = persona.system_prompt
+                                # 写回快照，同一轮后续重试无需再访问会话/人格管理器
+                                stored_params.system_prompt = system_prompt
                                 logger.debug(f"重试时成功从 Persona '{target_persona_id}' 实时加载 system_prompt 作为兜底")
                 except Exception as e:
                     logger.warning(f"重试时实时加载 Persona 失败: {e}")
@@ -402,8 +482,8 @@ class Main(Star):
             # === Bug 1.2: 上下文重建 ===
             # 重建 contexts 列表，将存储的 prompt 作为最后一个 user 角色的消息追加
             # 必须使用深拷贝，否则会污染 pending_requests 中的 stored_params，导致多次重试时 prompt 重复叠加
-            contexts = copy.deepcopy(stored_params.get("contexts", []))
-            prompt = stored_params.get("prompt")
+            contexts = copy.deepcopy(stored_params.contexts)
+            prompt = stored_params.prompt
             
             # 确保不重复添加 prompt (防止上下文中已包含的情况)
             if prompt:
@@ -419,17 +499,22 @@ class Main(Star):
             kwargs["contexts"] = contexts
             
             # === 恢复Provider特定参数 ===
-            if "provider_params" in stored_params:
-                provider_params = stored_params["provider_params"]
-                # 只添加非None的参数
-                for param_name, param_value in provider_params.items():
-                    if param_value is not None:
-                        kwargs[param_name] = param_value
-                        logger.debug(f"恢复Provider参数: {param_name}={param_value}")
-
-            logger.debug(
-                f"正在执行重试，prompt前50字符: '{stored_params['prompt'][:50]}...'"
-            )
+            # 只添加非None的参数
+            for param_name, param_value in stored_params.provider_params.items():
+                if param_value is not None:
+                    kwargs[param_name] = param_value
+
+            # 调试预览仅在 DEBUG 级别开启时才格式化
+            if logger.isEnabledFor(logging.DEBUG):
+                restored = ", ".join(
+                    f"{name}={value}"
+                    for name, value in stored_params.provider_params.items()
+                    if value is not None
+                )
+                logger.debug(
+                    f"正在执行重试，恢复Provider参数: [{restored}]，"
+                    f"prompt前50字符: '{stored_params.prompt[:50]}...'"
+                )
 
             llm_response = await provider.text_chat(**kwargs)
             return llm_response
@@ -453,16 +538,16 @@ class Main(Star):
             conv_mgr = self.context.conversation_manager
             umo = event.unified_msg_origin
             # Use stored conversation_id if available, otherwise get current
-            cid = stored_params.get("conversation_id")
+            cid = stored_params.conversation_id
             if not cid:
                 cid = await conv_mgr.get_curr_conversation_id(umo)
             
             conv = await conv_mgr.get_conversation(umo, cid)
-            prompt = stored_params.get("prompt")
+            prompt = stored_params.prompt
 
             if conv and prompt:
                 # Manually modify and update the conversation history
-                history_list = json.loads(conv.history) if conv.history else []
+                history_list = _json_loads(conv.history) if conv.history else []
                 
                 # Check if user prompt is already the last message to avoid duplication
                 if not history_list or history_list[-1].get("content") != prompt:
@@ -534,10 +619,12 @@ class Main(Star):
     ) -> bool:
         """顺序重试序列（从原_execute_retry_sequence方法拆分出来）"""
         delay = initial_delay
+        exponential_delay = self._exponential_delay
 
         for attempt in range(1, max_attempts + 1):
             logger.info(f"第 {attempt}/{max_attempts} 次重试...")
 
+            await self._wait_for_cooldown()
             new_response = await self._perform_retry_with_stored_params(request_key)
 
             if not new_response or not getattr(new_response, "completion_text", ""):
@@ -546,29 +633,29 @@ class Main(Star):
                 new_text = new_response.completion_text.strip()
 
                 # 检查新回复是否包含错误
-                new_text_lower = new_text.lower()
-                has_error = any(
-                    keyword in new_text_lower for keyword in self.error_keywords
-                )
+                has_error = self._match_error_keyword(new_text) is not None
 
-                # 状态码检测
-                code = self._extract_status_code(new_text)
+                # 状态码检测（未配置任何状态码时整体跳过）
+                code = (
+                    self._extract_status_code(new_text)
+                    if self._check_status_codes
+                    else None
+                )
                 if code is not None:
                     if code in self.non_retryable_status_codes:
                         logger.warning(f"检测到不可重试状态码 {code}，提前结束重试")
                         return False
                     if code in self.retryable_status_codes:
                         has_error = True
+                        if code == 429:
+                            self._mark_rate_limited()
 
                 if new_text and not has_error:
                     logger.info(f"第 {attempt} 次重试成功，生成有效回复")
                     # Bug 1.3: 修复历史记录，同时保存Bot回复
                     await self._fix_user_history(event, request_key, bot_reply=new_text)
                     # 确保重试结果被正确标记为LLM结果，以便TTS等插件能正确处理
-                    result = MessageEventResult()
-                    result.message(new_text)
-                    result.result_content_type = ResultContentType.LLM_RESULT
-                    event.set_result(result)
+                    event.set_result(self._build_llm_result(new_text))
                     return True
                 else:
                     logger.warning(
@@ -577,12 +664,31 @@ class Main(Star):
 
             # 等待后重试
             if attempt < max_attempts and delay > 0:
-                await asyncio.sleep(delay)
-                if self.retry_delay_mode == "exponential":
+                if self.enable_backoff_jitter:
+                    # ±20% 抖动，避免多个会话的重试同步打到服务商
+                    await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+                else:
+                    await asyncio.sleep(delay)
+                if exponential_delay:
                     delay = min(delay * 2, 30)
 
         return False
 
+    def _mark_rate_limited(self) -> None:
+        """检测到 429 限流后登记冷却期（插件全局生效，所有会话的重试都会等待）"""
+        cooldown = self._rate_limit_cooldown
+        if cooldown <= 0:
+            return
+        self._cooldown_until = max(self._cooldown_until, time.monotonic() + cooldown)
+        logger.debug(f"检测到限流状态码 429，{cooldown}s 内暂停发起新的重试")
+
+    async def _wait_for_cooldown(self) -> None:
+        """处于限流冷却期时先等待冷却结束，避免发起注定被拒绝的请求"""
+        wait = self._cooldown_until - time.monotonic()
+        if wait > 0:
+            logger.debug(f"处于限流冷却期，等待 {wait:.1f}s 后再重试")
+            await asyncio.sleep(wait)
+
     async def _concurrent_retry_sequence(
         self, event: AstrMessageEvent, request_key: str, remaining_attempts: int
     ) -> bool:
@@ -597,18 +703,19 @@ class Main(Star):
             # 计算指数增长的并发数，但有合理上限控制
             if self.enable_exponential_growth:
                 base_count = self.concurrent_retry_count
-                exponential_count = base_count * (
-                    2 ** (batch_number - 1)
-                )  # 2, 4, 8, 16...
+                multiplier = 1 << (batch_number - 1)
+                exponential_count = base_count * multiplier  # 2, 4, 8, 16...
 
                 current_concurrent_count = min(
                     exponential_count,  # 指数增长的并发数
                     remaining_attempts - attempts_used,  # 不超过剩余次数
-                    self.concurrent_retry_count
-                    * self.max_concurrent_multiplier,  # 上限：基础并发数的倍数
-                    self.absolute_concurrent_limit,  # 绝对上限
+                    self._hard_concurrent_cap,  # 上限：基础并发数的倍数与绝对上限
+                )
+                growth_info = (
+                    f"(指数增长: {base_count}×{multiplier}={exponential_count}, 实际={current_concurrent_count})"
+                    if logger.isEnabledFor(logging.INFO)
+                    else ""
                 )
-                growth_info = f"(指数增长: {base_count}×{2 ** (batch_number - 1)}={exponential_count}, 实际={current_concurrent_count})"
             else:
                 current_concurrent_count = min(
                     self.concurrent_retry_count,  # 固定并发数量
@@ -621,6 +728,7 @@ class Main(Star):
             )
 
             # 执行并发批次 - 遵循官方异步规范
+            await self._wait_for_cooldown()
             batch_success = await self._single_concurrent_batch(
                 event, request_key, current_concurrent_count
             )
@@ -637,40 +745,53 @@ class Main(Star):
 
             # 批次间延迟 - 遵循官方性能规范，避免过于频繁请求
             if attempts_used < remaining_attempts:
-                await asyncio.sleep(1)
+                if self.enable_backoff_jitter:
+                    # 带抖动的指数退避：1s 起步，上限 5s，抖动只向上加，
+                    # 保证批次间隔不短于关闭抖动时的固定 1s，避免多个会话同步打到服务商
+                    backoff = min(1 << (batch_number - 2), 5)
+                    await asyncio.sleep(backoff * (1 + 0.5 * random.random()))
+                else:
+                    await asyncio.sleep(1)
 
         logger.warning(f"所有 {batch_number - 1} 个并发批次均失败")
         return False
 
-    async def _single_concurrent_batch(
-        self, event: AstrMessageEvent, request_key: str, concurrent_count: int
-    ) -> bool:
-        """执行单个并发批次"""
-        # 用于存储第一个有效结果
-        first_valid_result = None
-        result_lock = asyncio.Lock()
-
-        async def single_concurrent_attempt(attempt_id: int):
-            """单个并发重试任务"""
-            nonlocal first_valid_result
-
+    async def _single_concurrent_attempt(
+        self,
+        attempt_id: int,
+        request_key: str,
+        first_result_future: asyncio.Future,
+    ) -> Optional[str]:
+        """单个并发重试任务，首个有效结果写入 first_result_future"""
+        try:
+            logger.debug(f"并发重试任务 #{attempt_id} 开始")
+            # 单个任务自带超时，即使批次已返回也不会无限挂起
             try:
-                logger.debug(f"并发重试任务 #{attempt_id} 开始")
-                new_response = await self._perform_retry_with_stored_params(request_key)
+                async with _aio_timeout(self.concurrent_retry_timeout):
+                    new_response = await self._perform_retry_with_stored_params(
+                        request_key
+                    )
+            except asyncio.TimeoutError:
+                logger.debug(f"并发重试任务 #{attempt_id} 超时")
+                return None
 
-                if not new_response or not getattr(new_response, "completion_text", ""):
-                    logger.debug(f"并发重试任务 #{attempt_id} 返回空结果")
-                    return None
+            # 已有其他任务胜出时直接丢弃，省去后续文本检测
+            if first_result_future.done():
+                logger.debug(f"并发重试任务 #{attempt_id} 获得结果但已有首个结果，丢弃")
+                return None
 
-                new_text = new_response.completion_text.strip()
+            if not new_response or not getattr(new_response, "completion_text", ""):
+                logger.debug(f"并发重试任务 #{attempt_id} 返回空结果")
+                return None
 
-                # 检查新回复是否包含错误
-                new_text_lower = new_text.lower()
-                has_error = any(
-                    keyword in new_text_lower for keyword in self.error_keywords
-                )
+            new_text = new_response.completion_text.strip()
+            if not new_text:
+                logger.debug(f"并发重试任务 #{attempt_id} 返回空结果")
+                return None
 
-                # 状态码检测
+            # 状态码检测（先于关键词检测，命中后可跳过关键词扫描）
+            has_error = False
+            if self._check_status_codes:
                 code = self._extract_status_code(new_text)
                 if code is not None:
                     if code in self.non_retryable_status_codes:
@@ -680,88 +801,84 @@ class Main(Star):
                         return None
                     if code in self.retryable_status_codes:
                         has_error = True
-
-                if new_text and not has_error:
-                    # 使用锁确保线程安全
-                    async with result_lock:
-                        if first_valid_result is None:
-                            # Bug 1.3: 修复历史记录，同时保存Bot回复
-                            await self._fix_user_history(event, request_key, bot_reply=new_text)
-                            first_valid_result = new_text
-                            logger.info(f"并发重试任务 #{attempt_id} 获得首个有效结果")
-                            return new_text
-                        else:
-                            logger.debug(
-                                f"并发重试任务 #{attempt_id} 获得结果但已有首个结果，丢弃"
-                            )
-                            return None
+                        if code == 429:
+                            self._mark_rate_limited()
+
+            # 检查新回复是否包含错误
+            if not has_error:
+                has_error = self._match_error_keyword(new_text) is not None
+
+            if not has_error:
+                if not first_result_future.done():
+                    first_result_future.set_result(new_text)
+                    logger.info(f"并发重试任务 #{attempt_id} 获得首个有效结果")
+                    return new_text
                 else:
-                    logger.debug(f"并发重试任务 #{attempt_id} 结果包含错误或为空")
+                    logger.debug(
+                        f"并发重试任务 #{attempt_id} 获得结果但已有首个结果，丢弃"
+                    )
                     return None
-
-            except Exception as e:
-                logger.error(f"并发重试任务 #{attempt_id} 发生异常: {e}")
+            else:
+                logger.debug(f"并发重试任务 #{attempt_id} 结果包含错误")
                 return None
 
+        except Exception as e:
+            logger.error(f"并发重试任务 #{attempt_id} 发生异常: {e}")
+            return None
+
+    async def _single_concurrent_batch(
+        self, event: AstrMessageEvent, request_key: str, concurrent_count: int
+    ) -> bool:
+        """执行单个并发批次"""
+        # 首个有效结果直接写入该 Future，事件循环单线程执行，检查 done() 后赋值无需加锁
+        loop = asyncio.get_running_loop()
+        first_result_future = loop.create_future()
+
         # 创建并发任务
         tasks = [
-            asyncio.create_task(single_concurrent_attempt(i))
+            loop.create_task(
+                self._single_concurrent_attempt(i, request_key, first_result_future),
+                name=f"{request_key}#attempt-{i}",
+            )
             for i in range(1, concurrent_count + 1)
         ]
+        self._inflight_tasks.update(tasks)
+        for task in tasks:
+            task.add_done_callback(self._inflight_tasks.discard)
+            task.add_done_callback(_consume_task_exception)
 
-        try:
-            # 使用循环等待，确保"等待首个成功或全部失败"的正确逻辑
-            remaining_tasks = set(tasks)
-            start_time = asyncio.get_event_loop().time()
-
-            while remaining_tasks and not first_valid_result:
-                # 检查超时
-                elapsed = asyncio.get_event_loop().time() - start_time
-                if elapsed >= self.concurrent_retry_timeout:
-                    logger.warning(f"并发重试超时（{self.concurrent_retry_timeout}s）")
-                    break
-
-                # 等待至少一个任务完成，使用剩余时间作为超时
-                remaining_timeout = max(0.1, self.concurrent_retry_timeout - elapsed)
-                done, still_pending = await asyncio.wait(
-                    remaining_tasks,
-                    timeout=remaining_timeout,
-                    return_when=asyncio.FIRST_COMPLETED,
-                )
-
-                # 更新剩余任务集合
-                remaining_tasks = still_pending
-
-                # 检查完成的任务（但不处理结果，结果已在single_concurrent_attempt中处理）
-                for task in done:
-                    try:
-                        await task  # 确保任务完全完成
-                    except Exception as e:
-                        logger.debug(f"任务完成时出现异常（已忽略）: {e}")
+        # 等待"首个成功"或"全部结束"，二者任一发生即返回；只调用一次 asyncio.wait，
+        # 避免循环中反复注册回调和重新计算剩余超时
+        all_finished = asyncio.gather(*tasks, return_exceptions=True)
 
-                # 如果已经有有效结果，立即跳出循环
-                if first_valid_result:
-                    break
+        try:
+            await asyncio.wait(
+                {first_result_future, all_finished},
+                timeout=self.concurrent_retry_timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            first_valid_result = (
+                first_result_future.result() if first_result_future.done() else None
+            )
+            if not first_valid_result and not all_finished.done():
+                logger.warning(f"并发重试超时（{self.concurrent_retry_timeout}s）")
 
-            # 取消所有剩余任务
+            # 取消所有剩余任务，不等待其响应取消，异常由 done 回调统一读取
+            remaining_tasks = [task for task in tasks if not task.done()]
             for task in remaining_tasks:
-                if not task.done():
-                    task.cancel()
-                    try:
-                        await task
-                    except asyncio.CancelledError:
-                        pass
+                task.cancel()
 
             # 检查最终结果 - 遵循官方结果处理规范
             if first_valid_result:
+                # Bug 1.3: 修复历史记录，同时保存Bot回复
+                await self._fix_user_history(
+                    event, request_key, bot_reply=first_valid_result
+                )
                 # 确保并发重试结果也被正确标记为LLM结果
-                result = MessageEventResult()
-                result.message(first_valid_result)
-                result.result_content_type = ResultContentType.LLM_RESULT
-                event.set_result(result)
+                event.set_result(self._build_llm_result(first_valid_result))
 
                 # 清理剩余任务 - 遵循官方资源管理规范
-                cancelled_count = len([t for t in remaining_tasks if not t.done()])
+                cancelled_count = len(remaining_tasks)
                 if cancelled_count > 0:
                     logger.debug(f"并发重试成功，已取消 {cancelled_count} 个剩余任务")
                 else:
@@ -775,32 +892,36 @@ class Main(Star):
         except Exception as e:
             logger.error(f"并发批次执行异常: {e}")
             # 确保异常情况下的资源清理
-            await self._cleanup_concurrent_tasks(tasks)
+            self._cleanup_concurrent_tasks(tasks)
 
             # 检查是否有结果可用
-            if first_valid_result:
-                result = MessageEventResult()
-                result.message(first_valid_result)
-                result.result_content_type = ResultContentType.LLM_RESULT
-                event.set_result(result)
+            if first_result_future.done():
+                await self._fix_user_history(
+                    event, request_key, bot_reply=first_result_future.result()
+                )
+                event.set_result(self._build_llm_result(first_result_future.result()))
                 logger.info("异常期间获得有效结果，仍然返回成功")
                 return True
 
             return False
 
+    def _build_llm_result(self, text: str) -> MessageEventResult:
+        """构建标记为LLM结果的消息结果，以便TTS等插件能正确处理"""
+        result = MessageEventResult()
+        result.message(text)
+        result.result_content_type = ResultContentType.LLM_RESULT
+        return result
+
     def _handle_retry_failure(self, event: AstrMessageEvent) -> None:
         """处理重试失败的情况，遵循AstrBot事件处理规范"""
         logger.error(f"所有 {self.max_attempts} 次重试均失败")
 
         # 发送兜底回复
-        if self.fallback_reply and self.fallback_reply.strip():
+        if self.fallback_reply:
             # 确保兜底回复也被标记为LLM结果
             # Bug 3: 确保兜底回复能正确返回给用户，使用 PLAIN 类型可能更稳妥，或者确保 LLM_RESULT 被正确处理
             # 这里我们保持 LLM_RESULT 但确保消息内容正确
-            result = MessageEventResult()
-            result.message(self.fallback_reply.strip())
-            result.result_content_type = ResultContentType.LLM_RESULT
-            event.set_result(result)
+            event.set_result(self._build_llm_result(self.fallback_reply))
             logger.info("已发送兜底回复消息（标记为LLM结果）")
         else:
             # 如果没有兜底回复，确保清除结果并停止事件，防止空回复
@@ -826,70 +947,60 @@ class Main(Star):
         if request_key not in self.pending_requests:
             return
 
-        # 使用现有的响应失败检测逻辑
-        # 这里我们需要将LLMResponse转换为类似result的格式来复用现有逻辑
+        # 使用现有的响应失败检测逻辑，回复文本只读取一次
         should_retry = False
+        completion_text = resp.completion_text or ""
 
         # 检测底层provider的截断标记
-        if resp.completion_text and "[TRUNCATED_BY_LENGTH]" in resp.completion_text:
+        if "[TRUNCATED_BY_LENGTH]" in completion_text:
             should_retry = True
             logger.info("检测到provider层面的截断标记，需要重试")
             # 清理截断标记
-            resp.completion_text = resp.completion_text.replace(
+            resp.completion_text = completion_text.replace(
                 "[TRUNCATED_BY_LENGTH]", ""
             ).strip()
 
         # 核心修改：简化并加强截断检测
         # 唯一的、最可靠的依据是服务商返回的 finish_reason
         elif self.enable_truncation_retry and (
-            (hasattr(resp, "finish_reason") and resp.finish_reason == "length")
-            or (
-                hasattr(resp, "raw_completion")
-                and resp.raw_completion
-                and hasattr(resp.raw_completion, "choices")
-                and resp.raw_completion.choices
-                and getattr(resp.raw_completion.choices[0], "finish_reason", None)
-                == "length"
-            )
+            getattr(resp, "finish_reason", None) == "length"
+            or _raw_finish_reason(resp) == "length"
         ):
             should_retry = True
             logger.info(
                 "检测到LLM响应因达到最大长度而被截断 (finish_reason='length')，需要重试。"
             )
 
-        elif not resp.completion_text or not resp.completion_text.strip():
-            # 空回复需要重试
+        elif not completion_text or completion_text.isspace():
+            # 空回复需要重试（isspace 无需为长回复生成去空白副本）
             should_retry = True
             logger.debug("检测到空的LLM响应，需要重试")
         else:
-            # 如果有文本内容，创建一个临时result对象来检测其他错误情况（不包括截断）
-            temp_result = MessageEventResult()
-            temp_result.chain = [Comp.Plain(text=resp.completion_text)]
-
-            # 使用现有的检测逻辑（但排除截断检测，因为已经在上面处理了）
-            should_retry = self._should_retry_response(temp_result)
+            # 如果有文本内容，直接对文本检测其他错误情况（不包括截断），
+            # 无需为此构造临时的 MessageEventResult 和 Plain 消息段
+            should_retry = self._should_retry_text(completion_text)
 
         if not should_retry:
             return
 
         logger.info("在LLM响应阶段检测到需要重试的情况")
 
-        # 执行重试序列
-        retry_success = await self._execute_retry_sequence(event, request_key)
-
-        if retry_success:
-            # 重试成功，新的结果已在 event 中通过 set_result() 设置。
-            # 我们相信框架会优先处理 set_result 的结果，因此无需再修改原始的 resp 对象。
-            # 这是一个更纯净、更符合框架设计理念的做法。
-            logger.info("LLM响应已通过重试更新，框架将使用新设置的结果。")
-        else:
-            # Bug 2: 逻辑归一, 调用通用失败处理函数
-            self._handle_retry_failure(event)
-
-        # 清理存储的请求参数
-        if request_key in self.pending_requests:
-            del self.pending_requests[request_key]
-            logger.debug(f"LLM响应阶段已清理请求参数: {request_key}")
+        try:
+            # 执行重试序列
+            retry_success = await self._execute_retry_sequence(event, request_key)
+
+            if retry_success:
+                # 重试成功，新的结果已在 event 中通过 set_result() 设置。
+                # 我们相信框架会优先处理 set_result 的结果，因此无需再修改原始的 resp 对象。
+                # 这是一个更纯净、更符合框架设计理念的做法。
+                logger.info("LLM响应已通过重试更新，框架将使用新设置的结果。")
+            else:
+                # Bug 2: 逻辑归一, 调用通用失败处理函数
+                self._handle_retry_failure(event)
+        finally:
+            # 清理存储的请求参数（重试过程异常时同样清理，避免残留）
+            if self.pending_requests.pop(request_key, None) is not None:
+                logger.debug(f"LLM响应阶段已清理请求参数: {request_key}")
 
     @filter.on_decorating_result(priority=-100)
     async def check_and_retry(self, event: AstrMessageEvent, *args, **kwargs):
@@ -904,32 +1015,32 @@ class Main(Star):
             # 已经被LLM响应钩子处理过，直接返回
             return
 
+        # 无论走哪个分支，结束时统一清理存储的请求参数
+        try:
+            await self._check_and_retry_stored(event, request_key)
+        finally:
+            if self.pending_requests.pop(request_key, None) is not None:
+                logger.debug(f"结果装饰阶段已清理请求参数: {request_key}")
+
+    async def _check_and_retry_stored(
+        self, event: AstrMessageEvent, request_key: str
+    ) -> None:
+        """结果装饰阶段的检测与重试逻辑，请求参数由调用方统一清理"""
         # 检查原始LLM响应，如果是工具调用则不干预
         llm_response = getattr(event, "llm_response", None)
-        if llm_response and hasattr(llm_response, "choices") and llm_response.choices:
-            finish_reason = getattr(llm_response.choices[0], "finish_reason", None)
-            if finish_reason == "tool_calls":
-                logger.debug("检测到正常的工具调用，不进行干预")
-                # 清理请求参数
-                if request_key in self.pending_requests:
-                    del self.pending_requests[request_key]
-                return
+        if _choice_finish_reason(llm_response) == "tool_calls":
+            logger.debug("检测到正常的工具调用，不进行干预")
+            return
 
         result = event.get_result()
 
         # 检查是否需要重试
         if not self._should_retry_response(result):
-            # 清理请求参数
-            if request_key in self.pending_requests:
-                del self.pending_requests[request_key]
             return
 
         # 只有在用户发送了文本内容时才进行重试
         if not event.message_str or not event.message_str.strip():
             logger.debug("用户消息为空，跳过重试")
-            # 清理请求参数
-            if request_key in self.pending_requests:
-                del self.pending_requests[request_key]
             return
 
         logger.info("在结果装饰阶段检测到需要重试的情况（备用处理）")
@@ -941,30 +1052,17 @@ class Main(Star):
         if not retry_success:
             self._handle_retry_failure(event)
 
-        # 清理存储的请求参数
-        if request_key in self.pending_requests:
-            del self.pending_requests[request_key]
-            logger.debug(f"结果装饰阶段已清理请求参数: {request_key}")
-
-
-    async def _cleanup_concurrent_tasks(self, tasks):
+    def _cleanup_concurrent_tasks(self, tasks):
         """安全清理并发任务，遵循AstrBot资源管理规范"""
         if not tasks:
             return
 
+        # 只发出取消请求而不逐个等待，任务异常由 done 回调读取
         cleanup_count = 0
         for task in tasks:
             if not task.done():
                 task.cancel()
                 cleanup_count += 1
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    # 官方推荐：正常的取消操作，不记录为错误
-                    pass
-                except Exception as e:
-                    # 使用官方logger记录清理异常
-                    logger.debug(f"清理并发任务时出现异常: {e}")
 
         if cleanup_count > 0:
             logger.debug(f"已清理 {cleanup_count} 个未完成的并发任务")
@@ -973,6 +1071,14 @@ class Main(Star):
         """插件卸载时清理资源，遵循官方生命周期规范"""
         # 清理存储的请求参数
         self.pending_requests.clear()
+
+        # 回收仍在运行的并发重试任务
+        if self._inflight_tasks:
+            tasks = list(self._inflight_tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._inflight_tasks.clear()
         logger.info("已卸载 [IntelligentRetry] 插件并清理所有资源")
 
 